@@ -1,28 +1,114 @@
 import os
-import json
+import csv
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
 import re
-from flask import Flask, request, Response
+import string
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache, partial
+from itertools import islice
+from flask import Flask, request, Response, g
 from flask_sqlalchemy import SQLAlchemy
-from predictor import predict_disease, cols
+from sqlalchemy import delete, event
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from rapidfuzz import process, fuzz
+
+# predictor trains its model at import (several seconds), so it's loaded on
+# first use; the symptom names come straight from the dataset header. The
+# header repeats fluid_overload, and predictor folds the copy into one column,
+# so drop repeats here the same way
+with open("Data/Training.csv", newline="") as f:
+    cols = list(dict.fromkeys(next(csv.reader(f))[:-1]))
+
+@cache
+def load_predictor():
+    import predictor
+    missing = set(predictor.symptom_names) - _FOLLOWUP_PROMPTS.keys()
+    if missing:
+        logging.error(f"Predictor symptoms without a follow-up prompt: {sorted(missing)}")
+    return predictor
+
+# Symptom names never change at runtime, so lowercase them and build their
+# list rows once
+_COLS_LOWER = [s.lower() for s in cols]
+_COLS_ROWS = [{"id": f"symptom_{s}", "title": s.replace("_", " ").title()[:24]} for s in cols]
+_FINISH_ROW = {"id": "finish", "title": "✅ Finish"}
+# Button/list id → stored symptom name, and display titles keyed by either the
+# dataset name ("skin_rash") or the stored name ("skin rash")
+_ID_TO_SYMPTOM = {row["id"]: lower.replace("_", " ") for row, lower in zip(_COLS_ROWS, _COLS_LOWER)}
+_SYMPTOM_TITLES = {name: lower.replace("_", " ").title()
+                   for lower in _COLS_LOWER for name in (lower, lower.replace("_", " "))}
+
+# Fixed parts of the interactive messages; only rows and titles vary per message
+_SEARCH_BODY = {"text": "🔍 Did you mean one of these symptoms?"}
+_ADD_MORE_ACTION = {"buttons": [
+    {"type": "reply", "reply": {"id": "add_more", "title": "Add More"}},
+    {"type": "reply", "reply": {"id": "finish", "title": "Finish"}}
+]}
+def build_followup_prompt(lower):
+    title = _SYMPTOM_TITLES.get(lower) or lower.replace("_", " ").title()
+    return {
+        "type": "button",
+        "body": {"text": f"Do you also have: {title}?"},
+        "action": {"buttons": [
+            {"type": "reply", "reply": {"id": f"followup_yes_{lower}", "title": "Yes"}},
+            {"type": "reply", "reply": {"id": f"followup_no_{lower}", "title": "No"}}
+        ]}
+    }
 
-try:
-    from predictor import suggest_symptoms
-except ImportError:
-    from difflib import get_close_matches
+_FOLLOWUP_PROMPTS = {lower: build_followup_prompt(lower) for lower in _COLS_LOWER}
 
-    def suggest_symptoms(partial: str, n: int = 5):
-        """Fallback fuzzy symptom search if predictor doesn't define suggest_symptoms"""
-        partial = partial.strip().lower().replace(" ", "_")
-        matches = get_close_matches(partial, [s.lower() for s in cols], n=n, cutoff=0.4)
-        return matches
+def suggest_symptoms(partial: str, n: int = 5):
+    predictor = load_predictor()
+    if hasattr(predictor, "suggest_symptoms"):
+        return predictor.suggest_symptoms(partial, n=n)
+    # Fallback fuzzy symptom search if predictor doesn't define suggest_symptoms
+    from difflib import get_close_matches
+    partial = partial.strip().lower().replace(" ", "_")
+    return get_close_matches(partial, _COLS_LOWER, n=n, cutoff=0.4)
 
 
 
 app = Flask(__name__)
 logging.basicConfig(level=logging.INFO)
 
+# 🧵 Background workers for message handling (LLM + WhatsApp I/O)
+_POOL = ThreadPoolExecutor(max_workers=16)
+
+# Deliveries waiting per phone number. Only one worker drains a user's queue
+# at a time, so two deliveries from the same user never load and commit their
+# session row at once, while other users keep the rest of the pool.
+_inbox = {}
+_inbox_lock = threading.Lock()
+
+def queue_messages(phone_number, messages):
+    with _inbox_lock:
+        queue = _inbox.get(phone_number)
+        if queue is not None:
+            queue.append(messages)
+            return
+        _inbox[phone_number] = deque([messages])
+    _POOL.submit(_drain_inbox, phone_number)
+
+def _drain_inbox(phone_number):
+    while True:
+        with _inbox_lock:
+            queue = _inbox[phone_number]
+            if not queue:
+                del _inbox[phone_number]
+                return
+            messages = queue.popleft()
+        process_messages(phone_number, messages)
+
+# Warm the predictor up without holding back startup or the first webhook ACK
+threading.Thread(target=load_predictor, daemon=True).start()
+
 # 🔐 Environment variables
 OPENROUTER_API_KEY = os.getenv("OPENROUTER_API_KEY")
 WHATSAPP_TOKEN = os.getenv("WHATSAPP_TOKEN")
@@ -32,21 +118,99 @@ PHONE_NUMBER_ID = os.getenv("PHONE_NUMBER_ID")
 if not OPENROUTER_API_KEY or not WHATSAPP_TOKEN or not PHONE_NUMBER_ID:
     raise ValueError("Missing one or more required environment variables.")
 
+WHATSAPP_URL = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+OPENROUTER_MODEL = "deepseek/deepseek-chat-v3.1:free"
+
+# 🔌 One keep-alive HTTP session per upstream host, with its auth headers attached
+def make_http_session(headers, retry):
+    http = requests.Session()
+    http.headers.update(headers)
+    http.mount("https://", HTTPAdapter(pool_connections=20, pool_maxsize=100, max_retries=retry))
+    return http
+
+# Both APIs are called with POST, which urllib3 won't retry unless allowed.
+# WhatsApp only retries statuses where the message can't have gone out.
+_WHATSAPP_HTTP = make_http_session(
+    {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"},
+    Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 503],
+          allowed_methods=frozenset(["POST"]), respect_retry_after_header=True)
+)
+_OPENROUTER_HTTP = make_http_session(
+    {"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"},
+    Retry(total=5, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504],
+          allowed_methods=frozenset(["POST"]), respect_retry_after_header=True)
+)
+
 # 🧠 SQLite setup
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///sessions.db'
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# JSON columns are (de)serialized with orjson
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    "json_serializer": lambda obj: orjson.dumps(obj).decode(),
+    "json_deserializer": orjson.loads,
+}
 db = SQLAlchemy(app)
 
 class UserSession(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
-    phone_number = db.Column(db.String(20), unique=True, nullable=False)
-    history = db.Column(db.Text, default="[]")  # JSON string
+    phone_number = db.Column(db.String(20), primary_key=True)
+    history = db.Column(db.JSON, default=list)  # Chat messages
     state = db.Column(db.String(50), default="idle")
-    selected_symptoms = db.Column(db.Text, default="[]")  # JSON list
-    followup_symptoms = db.Column(db.Text, default="[]")  # JSON list
+    selected_symptoms = db.Column(db.JSON, default=list)
+    followup_symptoms = db.Column(db.JSON, default=list)
+    history_summary = db.Column(db.Text, default="")  # Summary of turns trimmed from history
+
+def migrate_user_session():
+    # create_all() only creates missing tables, so upgrade older sessions.db files in place
+    columns = {c["name"] for c in db.inspect(db.engine).get_columns("user_session")}
+    with db.engine.begin() as conn:
+        if "history_summary" not in columns:
+            conn.execute(db.text("ALTER TABLE user_session ADD COLUMN history_summary TEXT DEFAULT ''"))
+        if "id" in columns:
+            # phone_number replaced the surrogate id as primary key; SQLite can't
+            # change a primary key, so rebuild the table and copy the rows over
+            conn.execute(db.text("ALTER TABLE user_session RENAME TO user_session_old"))
+            UserSession.__table__.create(conn)
+            conn.execute(db.text(
+                "INSERT INTO user_session "
+                "(phone_number, history, state, selected_symptoms, followup_symptoms, history_summary) "
+                "SELECT phone_number, history, state, selected_symptoms, followup_symptoms, history_summary "
+                "FROM user_session_old"
+            ))
+            conn.execute(db.text("DROP TABLE user_session_old"))
+
+def set_sqlite_pragmas(dbapi_conn, _record):
+    # WAL lets readers run alongside the writer, and NORMAL sync only fsyncs at
+    # checkpoints instead of on every commit
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.close()
 
 with app.app_context():
+    event.listen(db.engine, "connect", set_sqlite_pragmas)
     db.create_all()
+    migrate_user_session()
+
+# Handlers work on a live set of selected symptoms; it's written back to the
+# JSON column once, when the transaction commits
+def get_selected_symptoms(session):
+    if getattr(session, "_symptoms_cache", None) is None:
+        session._symptoms_saved = session.selected_symptoms or []
+        session._symptoms_cache = set(session._symptoms_saved)
+    return session._symptoms_cache
+
+@event.listens_for(db.session, "before_commit")
+def _store_selected_symptoms(db_session):
+    for obj in list(db_session.identity_map.values()):
+        cache = getattr(obj, "_symptoms_cache", None)
+        if cache is None:
+            continue
+        value = sorted(cache)
+        if value != obj._symptoms_saved:
+            obj.selected_symptoms = obj._symptoms_saved = value
 
 # 💬 Predefined responses
 DISCLAIMER = (
@@ -79,33 +243,84 @@ PREDEFINED_RESPONSES = {
     "check": "🩺 To check symptoms, type 'check'. I will guide you interactively to add symptoms and refine accuracy.",
 }
 
+# One combined pattern, compiled once, instead of a search per keyword
+_PREDEF_RE = re.compile(
+    r"\b(?P<k>" + "|".join(re.escape(k) for k in PREDEFINED_RESPONSES) + r")\b",
+    re.IGNORECASE
+)
+
+# Cheap pre-check: most messages contain none of the keyword words at all
+_PREDEF_WORDS = frozenset(w for k in PREDEFINED_RESPONSES for w in k.split())
+_PUNCT_TO_SPACE = str.maketrans(string.punctuation, " " * len(string.punctuation))
+# Same (Unicode) word boundaries as the \b in _PREDEF_RE, so "thanks🙏" or
+# "help’s" pass the pre-check whenever the pattern would match
+_WORD_RE = re.compile(r"\w+")
+
 def match_predefined(text):
-    text = text.lower().strip()
-    for key in PREDEFINED_RESPONSES:
-        if re.search(rf"\b{key}\b", text):
-            return PREDEFINED_RESPONSES[key]
+    # text arrives stripped and lowercased from handle_message
+    if _PREDEF_WORDS.isdisjoint(_WORD_RE.findall(text)):
+        return None
+    m = _PREDEF_RE.search(text)
+    if m:
+        return PREDEFINED_RESPONSES[m.group("k").lower()]
     return None
 
+# Trivial messages that would otherwise cost an LLM round trip
+SHORT_REPLY = "👍 Anything else I can help with? Type 'help' to see what I can do."
+_ACKNOWLEDGEMENTS = {"ok", "okk", "okay", "k", "kk", "ty", "thx", "👍", "👌", "🙏", "🙂", "😊"}
+_GREETING_RE = re.compile(
+    r"^(?:hey+|hi+|hii+ya|helo+|hola|namaste|namaskar|bonjour|ciao|hallo|salaa?m|"
+    r"good (?:morning|afternoon|evening))\W*$"
+)
+
+def match_trivial(text):
+    # text arrives stripped and lowercased from handle_message
+    # Only bare acknowledgements and emoji/punctuation; short words in other
+    # scripts ("发烧", "头痛") can be symptoms and still go to the LLM
+    if text in _ACKNOWLEDGEMENTS or not any(c.isalnum() for c in text):
+        return SHORT_REPLY
+    if len(text) > 20:
+        return None
+    if _GREETING_RE.match(text):
+        return PREDEFINED_RESPONSES["hi"]
+    # Misspelt keywords ("comand", "resorces", "emergncy")
+    match = process.extractOne(text, PREDEFINED_RESPONSES.keys(), scorer=fuzz.ratio, score_cutoff=85)
+    return PREDEFINED_RESPONSES[match[0]] if match else None
+
 # 🧠 Session functions
 def load_session(phone_number):
-    return UserSession.query.filter_by(phone_number=phone_number).first()
+    # Handlers reload the same row several times per message; query it once per app context
+    sessions = g.setdefault("sessions", {})
+    if phone_number not in sessions:
+        sessions[phone_number] = db.session.get(UserSession, phone_number)
+    return sessions[phone_number]
 
 def save_session(session):
+    # Committed once per webhook batch by handle_messages
     db.session.add(session)
-    db.session.commit()
 
 def clear_session(phone_number):
-    session = load_session(phone_number)
-    if session:
-        db.session.delete(session)
-        db.session.commit()
+    db.session.execute(delete(UserSession).where(UserSession.phone_number == phone_number))
+    g.setdefault("sessions", {}).pop(phone_number, None)
 
 def get_or_create_session(phone_number):
     session = load_session(phone_number)
-    if not session:
-        session = UserSession(phone_number=phone_number)
-        save_session(session)
-    return session
+    if session:
+        return session
+    # Single INSERT for new users; a concurrent insert for the same number is a no-op
+    stmt = (
+        sqlite_insert(UserSession)
+        .values(phone_number=phone_number)
+        .on_conflict_do_nothing(index_elements=["phone_number"])
+        .returning(UserSession)
+    )
+    session = db.session.scalars(stmt).one_or_none()
+    db.session.commit()
+    if session:
+        g.sessions[phone_number] = session
+        return session
+    g.sessions.pop(phone_number, None)
+    return load_session(phone_number)
 
 def log_interaction(phone_number, user_message=None, bot_message=None, session_state=None):
     log_parts = [f"📞 Phone: {phone_number}"]
@@ -118,30 +333,64 @@ def log_interaction(phone_number, user_message=None, bot_message=None, session_s
     logging.info(" | ".join(log_parts))
 
 # 📤 WhatsApp message functions
-def send_whatsapp_message(to_number, message_text):
-    url = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+# Each user is pinned to one single-threaded lane: callers don't wait on Meta,
+# and a user's messages are still delivered in the order they were queued.
+_SEND_LANES = [ThreadPoolExecutor(max_workers=1) for _ in range(8)]
+
+def _send_lane(to_number):
+    return _SEND_LANES[hash(to_number) % len(_SEND_LANES)]
+
+# Texts queued for a user while their lane is busy are joined into one send.
+# An interactive message closes the open batch so ordering is preserved.
+MAX_TEXT_LENGTH = 4096  # WhatsApp text body limit
+_pending_texts = {}
+_pending_lock = threading.Lock()
+
+def send_whatsapp_message(to_number, message_text, session_state=None):
+    with _pending_lock:
+        batch = _pending_texts.get(to_number)
+        if batch is None or sum(len(t) + 2 for t in batch) + len(message_text) > MAX_TEXT_LENGTH:
+            batch = _pending_texts[to_number] = []
+            _send_lane(to_number).submit(_deliver_batch, to_number, batch, session_state)
+        batch.append(message_text)
+
+def _deliver_batch(to_number, batch, session_state):
+    with _pending_lock:
+        if _pending_texts.get(to_number) is batch:
+            del _pending_texts[to_number]
+        message_text = "\n\n".join(batch)
     payload = {"messaging_product": "whatsapp", "to": to_number, "type": "text", "text": {"body": message_text}}
+    _deliver_message(payload, session_state)
+
+def _deliver_message(payload, session_state):
     try:
-        requests.post(url, headers=headers, json=payload)
-        log_interaction(to_number, bot_message=message_text, session_state=load_session(to_number).state)
+        _WHATSAPP_HTTP.post(WHATSAPP_URL, data=orjson.dumps(payload), timeout=(5, 15))
+        log_interaction(payload["to"], bot_message=payload["text"]["body"], session_state=session_state)
     except Exception as e:
         logging.error(f"WhatsApp send error: {e}")
 
-def send_whatsapp_interactive(to_number, interactive_payload):
-    url = f"https://graph.facebook.com/v17.0/{PHONE_NUMBER_ID}/messages"
-    headers = {"Authorization": f"Bearer {WHATSAPP_TOKEN}", "Content-Type": "application/json"}
+def send_whatsapp_interactive(to_number, interactive_payload, session_state=None):
+    payload = {
+        "messaging_product": "whatsapp",
+        "to": to_number,
+        "type": "interactive",
+        "interactive": interactive_payload
+    }
+    with _pending_lock:
+        _pending_texts.pop(to_number, None)
+        _send_lane(to_number).submit(_deliver_interactive, payload, session_state)
+
+def _deliver_interactive(payload, session_state):
     try:
-        resp = requests.post(url, headers=headers, json={
-            "messaging_product": "whatsapp",
-            "to": to_number,
-            "type": "interactive",
-            "interactive": interactive_payload
-        })
-        logging.info(f"WhatsApp API status: {resp.status_code}, response: {resp.text}")
+        resp = _WHATSAPP_HTTP.post(WHATSAPP_URL, data=orjson.dumps(payload), timeout=(5, 15))
+        logging.info("WhatsApp API status: %s, response: %s", resp.status_code, resp.text)
         if resp.status_code == 200:
-            log_interaction(to_number, bot_message=f"[Interactive] {json.dumps(interactive_payload)}",
-                            session_state=load_session(to_number).state)
+            # Log the prompt text; the full payload (up to ten list rows) only at DEBUG
+            interactive = payload["interactive"]
+            log_interaction(payload["to"], bot_message=f"[Interactive] {interactive['body']['text']}",
+                            session_state=session_state)
+            if logging.getLogger().isEnabledFor(logging.DEBUG):
+                logging.debug(f"Interactive payload: {orjson.dumps(interactive).decode()}")
     except Exception as e:
         logging.error(f"Interactive send error: {e}")
 
@@ -149,13 +398,14 @@ def send_whatsapp_interactive(to_number, interactive_payload):
 def start_symptom_checker(phone_number):
     session = get_or_create_session(phone_number)
     session.state = "symptom_check"
-    session.selected_symptoms = json.dumps([])
+    get_selected_symptoms(session).clear()
     save_session(session)
 
     send_whatsapp_message(
         phone_number,
         "🩺 Please type your symptom (e.g. 'headache', 'cough'). "
-        "I'll suggest matches. Type 'finish' when done."
+        "I'll suggest matches. Type 'finish' when done.",
+        session.state
     )
 
 def handle_symptom_search(phone_number, text):
@@ -167,24 +417,21 @@ def handle_symptom_search(phone_number, text):
         finish_symptom_check(phone_number)
         return
 
-    selected_symptoms = json.loads(session.selected_symptoms)
+    # Find matches from dataset (only the first 10 fit in the list message)
+    rows = list(islice((row for row, lower in zip(_COLS_ROWS, _COLS_LOWER) if text in lower), 10))
 
-    # Find matches from dataset
-    matches = [s for s in cols if text in s.lower()]
-
-    if not matches:
-        send_whatsapp_message(phone_number, f"⚠️ No matching symptoms found for '{text}'. Try again.")
+    if not rows:
+        send_whatsapp_message(phone_number, f"⚠️ No matching symptoms found for '{text}'. Try again.", session.state)
         return
 
-    # Build interactive list of up to 10 matches
-    rows = [{"id": f"symptom_{s}", "title": s.replace("_", " ").title()[:24]} for s in matches[:10]]
-    rows.append({"id": "finish", "title": "✅ Finish"})
+    # Interactive list of up to 10 matches
+    rows.append(_FINISH_ROW)
     interactive = {
         "type": "list",
-        "body": {"text": "🔍 Did you mean one of these symptoms?"},
+        "body": _SEARCH_BODY,
         "action": {"button": "Select", "sections": [{"title": "Suggestions", "rows": rows}]}
     }
-    send_whatsapp_interactive(phone_number, interactive)
+    send_whatsapp_interactive(phone_number, interactive, session.state)
 
 def handle_symptom_input(phone_number, user_text):
     session = load_session(phone_number)
@@ -198,16 +445,15 @@ def handle_symptom_input(phone_number, user_text):
 
     matches = suggest_symptoms(user_text, n=5)
     if not matches:
-        send_whatsapp_message(phone_number, "⚠️ No matches found. Try again with a different word.")
+        send_whatsapp_message(phone_number, "⚠️ No matches found. Try again with a different word.", session.state)
         return
 
     # If exact match, auto-add
-    selected = json.loads(session.selected_symptoms)
+    selected = get_selected_symptoms(session)
     if user_text in matches and user_text not in selected:
-        selected.append(user_text)
-        session.selected_symptoms = json.dumps(selected)
+        selected.add(user_text)
         save_session(session)
-        send_whatsapp_message(phone_number, f"✅ Added '{user_text}'. Type another symptom or 'done' to finish.")
+        send_whatsapp_message(phone_number, f"✅ Added '{user_text}'. Type another symptom or 'done' to finish.", session.state)
         return
 
     # Otherwise show suggestions
@@ -217,14 +463,14 @@ def handle_symptom_input(phone_number, user_text):
         "body": {"text": f"Did you mean one of these?"},
         "action": {"buttons": buttons}
     }
-    send_whatsapp_interactive(phone_number, interactive)
+    send_whatsapp_interactive(phone_number, interactive, session.state)
 
 def handle_symptom_selection(phone_number, selection_id):
     session = load_session(phone_number)
     if not session:
         return
 
-    selected_symptoms = json.loads(session.selected_symptoms)
+    selected_symptoms = get_selected_symptoms(session)
 
     # Finish check
     if selection_id == "finish":
@@ -232,98 +478,87 @@ def handle_symptom_selection(phone_number, selection_id):
         return
 
     # Add selected symptom
-    symptom_name = selection_id.replace("symptom_", "").replace("_", " ").lower()
+    symptom_name = _ID_TO_SYMPTOM.get(selection_id)
+    if symptom_name is None:
+        symptom_name = selection_id.replace("symptom_", "").replace("_", " ").lower()
     if symptom_name not in selected_symptoms:
-        selected_symptoms.append(symptom_name)
-
-    session.selected_symptoms = json.dumps(selected_symptoms)
-    save_session(session)
+        selected_symptoms.add(symptom_name)
+        save_session(session)
 
     interactive = {
         "type": "button",
-        "body": {"text": f"✅ Added: {symptom_name.title()}. Add more or finish?"},
-        "action": {"buttons": [
-            {"type": "reply", "reply": {"id": "add_more", "title": "Add More"}},
-            {"type": "reply", "reply": {"id": "finish", "title": "Finish"}}
-        ]}
+        "body": {"text": f"✅ Added: {_SYMPTOM_TITLES.get(symptom_name) or symptom_name.title()}. Add more or finish?"},
+        "action": _ADD_MORE_ACTION
     }
-    send_whatsapp_interactive(phone_number, interactive)
+    send_whatsapp_interactive(phone_number, interactive, session.state)
 
 # 🔹 Follow-up questions
 def finish_symptom_check(phone_number):
     session = load_session(phone_number)
     if not session:
         return
-    symptoms = json.loads(session.selected_symptoms)
+    symptoms = sorted(get_selected_symptoms(session))
     if not symptoms:
-        send_whatsapp_message(phone_number, "⚠️ You didn't add any symptoms. Please try again.")
+        send_whatsapp_message(phone_number, "⚠️ You didn't add any symptoms. Please try again.", session.state)
         return
 
-    result = predict_disease(symptoms, days=3)
+    result = load_predictor().predict_disease(symptoms, days=3)
     if "error" in result:
-        send_whatsapp_message(phone_number, result["error"])
+        send_whatsapp_message(phone_number, result["error"], session.state)
         return
 
     if "followup" in result and result["followup"]:
         # Save followups as a queue so we don’t repeat
         session.state = "followup_check"
-        session.followup_symptoms = json.dumps(result["followup"])
+        session.followup_symptoms = list(result["followup"])
         save_session(session)
         ask_next_followup(phone_number)
     else:
-        send_diagnosis(phone_number, result)
+        send_diagnosis(phone_number, result, session.state)
         session.state = "idle"
-        session.selected_symptoms = json.dumps([])
-        session.followup_symptoms = json.dumps([])  # reset followups
+        get_selected_symptoms(session).clear()
+        session.followup_symptoms = []  # reset followups
         save_session(session)
 
 def ask_next_followup(phone_number):
     session = load_session(phone_number)
-    followups = json.loads(session.followup_symptoms)
+    followups = session.followup_symptoms or []
     if not followups:
         # No more followups → finalize
-        symptoms = json.loads(session.selected_symptoms)
-        result = predict_disease(symptoms, days=3)
-        send_diagnosis(phone_number, result)
+        symptoms = sorted(get_selected_symptoms(session))
+        result = load_predictor().predict_disease(symptoms, days=3)
+        send_diagnosis(phone_number, result, session.state)
         session.state = "idle"
-        session.selected_symptoms = json.dumps([])
-        session.followup_symptoms = json.dumps([])
+        get_selected_symptoms(session).clear()
+        session.followup_symptoms = []
         save_session(session)
         return
 
-    next_symptom = followups.pop(0)  # ✅ remove so we don’t loop
-    session.followup_symptoms = json.dumps(followups)
+    next_symptom, *remaining = followups  # ✅ remove so we don’t loop
+    # Assign a new list: in-place changes to a JSON column aren't detected
+    session.followup_symptoms = remaining
     save_session(session)
 
-    buttons = [
-        {"type": "reply", "reply": {"id": f"followup_yes_{next_symptom}", "title": "Yes"}},
-        {"type": "reply", "reply": {"id": f"followup_no_{next_symptom}", "title": "No"}}
-    ]
-    interactive = {
-        "type": "button",
-        "body": {"text": f"Do you also have: {next_symptom.replace('_',' ').title()}?"},
-        "action": {"buttons": buttons}
-    }
-    send_whatsapp_interactive(phone_number, interactive)
+    prompt = _FOLLOWUP_PROMPTS.get(next_symptom) or build_followup_prompt(next_symptom)
+    send_whatsapp_interactive(phone_number, prompt, session.state)
 
 def handle_followup_response(phone_number, selection_id):
     session = load_session(phone_number)
     if not session:
         return
 
-    symptoms = json.loads(session.selected_symptoms)
+    symptoms = get_selected_symptoms(session)
 
     if selection_id.startswith("followup_yes_"):
         symptom = selection_id.replace("followup_yes_", "")
         if symptom not in symptoms:
-            symptoms.append(symptom)
-            session.selected_symptoms = json.dumps(symptoms)
+            symptoms.add(symptom)
+            save_session(session)
 
-    # No need to handle “no” → just skip
-    save_session(session)
+    # “No” (or a repeated “yes”) changes nothing, so there is nothing to write
     ask_next_followup(phone_number)
 
-def send_diagnosis(phone_number, result):
+def send_diagnosis(phone_number, result, session_state=None):
     msg = (
         f"🤖 Based on your symptoms, you may have: *{result['disease']}* "
         f"(confidence: {result['confidence']}%).\n\n"
@@ -331,47 +566,167 @@ def send_diagnosis(phone_number, result):
         f"⚠️ Severity: {result['severity'].title()}\n\n"
         f"💡 Precautions:\n" + "\n".join(f"- {p}" for p in result['precautions'])
     )
-    send_whatsapp_message(phone_number, msg)
-    send_whatsapp_message(phone_number, f"⚠️ {DISCLAIMER}")
+    send_whatsapp_message(phone_number, msg, session_state)
+    send_whatsapp_message(phone_number, f"⚠️ {DISCLAIMER}", session_state)
 
 # 🔹 OpenRouter fallback
-def call_openrouter(user_text, phone_number):
+SYSTEM_PROMPT = (
+    "You are Botcure — a cautious, empathetic health assistant designed to support general wellness. "
+    "Be multilingual, empathetic, clear, and culturally sensitive. "
+    "Avoid diagnosing or prescribing. Advise emergency care for red-flag symptoms. "
+    f"Always identify yourself as Botcure. "
+    f"End with this disclaimer:\n{DISCLAIMER}"
+)
+# The system prompt is the same leading block on every request. DeepSeek caches
+# repeated prefixes on its own; the cache_control breakpoint lets providers
+# that need one (Anthropic, Gemini) cache it too if the model is switched.
+_SYSTEM_MESSAGE = {"role": "system", "content": [
+    {"type": "text", "text": SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}
+]}
+
+SUMMARY_PROMPT = (
+    "Summarize this health-assistant conversation in a few sentences. "
+    "Keep the user's symptoms, concerns and any advice already given."
+)
+
+MAX_HISTORY_MESSAGES = 20  # stored chat messages before older ones are summarized
+KEEP_HISTORY_MESSAGES = 10  # messages kept verbatim after summarizing
+STREAM_CHUNK_CHARS = 500  # streamed text buffered before sending a paragraph early
+
+# Replies to opening questions, keyed by normalized text. Only a conversation's
+# first message is cached: later replies depend on the history sent with them.
+REPLY_CACHE_SIZE = 2048
+REPLY_CACHE_TTL = 24 * 60 * 60  # seconds
+_reply_cache = OrderedDict()
+_reply_cache_lock = threading.Lock()
+
+def normalize_question(text):
+    return " ".join(text.lower().translate(_PUNCT_TO_SPACE).split())
+
+def get_cached_reply(key):
+    with _reply_cache_lock:
+        entry = _reply_cache.get(key)
+        if not entry:
+            return None
+        stored_at, reply = entry
+        if time.monotonic() - stored_at > REPLY_CACHE_TTL:
+            del _reply_cache[key]
+            return None
+        _reply_cache.move_to_end(key)
+        return reply
+
+def cache_reply(key, reply):
+    with _reply_cache_lock:
+        _reply_cache[key] = (time.monotonic(), reply)
+        _reply_cache.move_to_end(key)
+        if len(_reply_cache) > REPLY_CACHE_SIZE:
+            _reply_cache.popitem(last=False)
+
+def call_openrouter(user_texts, phone_number):
     session = load_session(phone_number)
-    messages = json.loads(session.history) if session and session.history else []
-    messages.append({"role": "user", "content": user_text})
-
-    system_prompt = (
-        "You are Botcure — a cautious, empathetic health assistant designed to support general wellness. "
-        "Be multilingual, empathetic, clear, and culturally sensitive. "
-        "Avoid diagnosing or prescribing. Advise emergency care for red-flag symptoms. "
-        f"Always identify yourself as Botcure. "
-        f"End with this disclaimer:\n{DISCLAIMER}"
-    )
+    messages = list(session.history or []) if session else []
+    cache_key = None
+    if not messages and len(user_texts) == 1 and not (session and session.history_summary):
+        cache_key = normalize_question(user_texts[0])
+    messages.extend({"role": "user", "content": t} for t in user_texts)
+
+    cached = get_cached_reply(cache_key) if cache_key else None
+    if cached:
+        if session:
+            messages.append({"role": "assistant", "content": cached})
+            session.history = messages
+            save_session(session)
+        return cached
+
+    context = [_SYSTEM_MESSAGE]
+    if session and session.history_summary:
+        context.append({"role": "system", "content": f"Summary of the earlier conversation:\n{session.history_summary}"})
 
     payload = {
-        "model": "deepseek/deepseek-chat-v3.1:free",
+        "model": OPENROUTER_MODEL,
         "temperature": 0.7,
-        "messages": [{"role": "system", "content": system_prompt}] + messages
+        "stream": True,
+        "messages": context + messages
     }
 
     try:
-        resp = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions",
-            headers={"Authorization": f"Bearer {OPENROUTER_API_KEY}", "Content-Type": "application/json"},
-            json=payload,
-            timeout=30
-        )
-        resp.raise_for_status()
-        bot_reply = resp.json()["choices"][0]["message"]["content"].strip()
+        bot_reply, pending = "", ""
+        # Closing the streamed response hands its connection back to the pool
+        with _OPENROUTER_HTTP.post(
+            OPENROUTER_URL,
+            data=orjson.dumps(payload),
+            timeout=30,
+            stream=True
+        ) as resp:
+            resp.raise_for_status()
+            for line in resp.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue  # SSE keep-alive comments
+                data = line[len(b"data: "):]
+                if data == b"[DONE]":
+                    break
+                delta = orjson.loads(data)["choices"][0].get("delta", {}).get("content") or ""
+                bot_reply += delta
+                pending += delta
+                # Send finished paragraphs while the model is still generating,
+                # once there's enough text to be worth a message of its own
+                if len(pending) >= STREAM_CHUNK_CHARS and "\n\n" in pending:
+                    ready, pending = pending.rsplit("\n\n", 1)
+                    if ready.strip():
+                        send_whatsapp_message(phone_number, ready.strip(), session.state if session else None)
+        bot_reply = bot_reply.strip()
         if session:
             messages.append({"role": "assistant", "content": bot_reply})
-            session.history = json.dumps(messages)
+            session.history = messages
             save_session(session)
-        return bot_reply
+        if cache_key and bot_reply:
+            cache_reply(cache_key, bot_reply)
+        # Caller sends whatever is left after the last paragraph break
+        return pending.strip()
     except Exception as e:
         logging.error(f"❌ OpenRouter failed: {e}")
         return "⚠️ I'm currently unable to respond. Please try again later.\n\n" + DISCLAIMER
 
+def compact_history(phone_number):
+    # Once history hits the cap, fold the older half into history_summary so the
+    # stored row and the prompt sent to OpenRouter stay bounded
+    session = load_session(phone_number)
+    if not session or not session.history:
+        return
+    messages = session.history
+    if len(messages) <= MAX_HISTORY_MESSAGES:
+        return
+    older, recent = messages[:-KEEP_HISTORY_MESSAGES], messages[-KEEP_HISTORY_MESSAGES:]
+    summary = generate_summary(session.history_summary, older)
+    if summary:
+        session.history_summary = summary
+    session.history = recent
+    save_session(session)
+
+def generate_summary(previous_summary, messages):
+    transcript = "\n".join(f"{m['role']}: {m['content']}" for m in messages)
+    if previous_summary:
+        transcript = f"Earlier summary: {previous_summary}\n{transcript}"
+    payload = {
+        "model": OPENROUTER_MODEL,
+        "temperature": 0.3,
+        "messages": [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript}
+        ]
+    }
+    try:
+        resp = _OPENROUTER_HTTP.post(
+            OPENROUTER_URL,
+            data=orjson.dumps(payload),
+            timeout=30
+        )
+        resp.raise_for_status()
+        return orjson.loads(resp.content)["choices"][0]["message"]["content"].strip()
+    except Exception as e:
+        logging.error(f"❌ Summary failed: {e}")
+        return None
+
 # 🌐 Webhook
 @app.route('/webhook', methods=['GET'])
 def verify_webhook():
@@ -384,85 +739,151 @@ def verify_webhook():
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
-    data = request.get_json()
-    logging.info(f"Webhook received: {json.dumps(data)}")
+    try:
+        data = orjson.loads(request.get_data())
+    except orjson.JSONDecodeError:
+        return Response("Invalid JSON", status=400)
+    if logging.getLogger().isEnabledFor(logging.DEBUG):
+        logging.debug(f"Webhook received: {orjson.dumps(data).decode()}")
     if data.get("object") != "whatsapp_business_account":
         return Response("EVENT_RECEIVED", status=200)
 
+    tasks = []
     for entry in data.get("entry", []):
         for change in entry.get("changes", []):
             value = change.get("value", {})
             if "messages" not in value:
                 continue
-            messages = value["messages"]
             contacts = value.get("contacts", [])
-            phone_number = contacts[0]["wa_id"] if contacts else None
-            if not phone_number:
-                continue
+            default_number = contacts[0]["wa_id"] if contacts else None
+            # One task per sender, queued behind that sender's earlier
+            # deliveries: a user's run in order, different users concurrently
+            by_sender = {}
+            for message in value["messages"]:
+                phone_number = message.get("from") or default_number
+                if phone_number:
+                    by_sender.setdefault(phone_number, []).append(message)
+            tasks.extend(by_sender.items())
+
+    # Meta retries webhooks that aren't acknowledged quickly, so reply first
+    for phone_number, messages in tasks:
+        queue_messages(phone_number, messages)
+    return Response("EVENT_RECEIVED", status=200)
+
+def process_messages(phone_number, messages):
+    # Runs on a worker thread, so it needs its own app context (and DB session)
+    with app.app_context():
+        try:
+            handle_messages(phone_number, messages)
+        except Exception as e:
+            logging.error(f"Message processing error: {e}")
+
+def handle_reset(phone_number, session):
+    clear_session(phone_number)
+    send_whatsapp_message(phone_number, "🧹 Memory cleared. Let's start fresh!")
+
+def handle_debug(phone_number, session):
+    history = session.history or []
+    reply = "🧪 Current memory:\n" + "\n".join(
+        [f"{m['role']}: {m['content']}" for m in history]
+    ) if history else "🧪 No memory found."
+    send_whatsapp_message(phone_number, reply, session.state)
+
+def handle_check(phone_number, session):
+    start_symptom_checker(phone_number)
+
+_COMMAND_HANDLERS = {
+    "/reset": handle_reset,
+    "/debug": handle_debug,
+    "check": handle_check,
+}
+
+def handle_add_more(phone_number, interactive_id):
+    send_whatsapp_message(phone_number, "🩺 Please type another symptom:", load_session(phone_number).state)
+
+# State → interactive id handlers. Ids with a per-symptom suffix
+# ("symptom_<name>", "followup_yes_<name>") are keyed by their first segment.
+_INTERACTIVE_HANDLERS = {
+    "symptom_check": {
+        "finish": handle_symptom_selection,
+        "add_more": handle_add_more,
+        "symptom": handle_symptom_selection,
+    },
+    "followup_check": {
+        "followup": handle_followup_response,
+    },
+}
 
+def handle_messages(phone_number, messages):
+    # Handlers only mutate the session; everything is flushed and committed once
+    # for the whole batch rather than on each query or message
+    llm_texts = []
+    with db.session.no_autoflush:
+        for message in messages:
+            # Cached after the first lookup; recreated if a /reset deleted it
             session = get_or_create_session(phone_number)
+            llm_text, action = route_message(phone_number, session, message)
+            if llm_text:
+                llm_texts.append(llm_text)
+                continue
+            if action:
+                # Answer the free text queued so far before replying to this one
+                if llm_texts:
+                    answer_with_llm(phone_number, llm_texts)
+                    llm_texts = []
+                action()
+    db.session.commit()
 
-            for message in messages:
-                text = message.get("text", {}).get("body", "").strip().lower()
-                interactive_id = None
-                if "interactive" in message:
-                    interactive = message["interactive"]
-                    if interactive["type"] == "button_reply":
-                        interactive_id = interactive["button_reply"]["id"]
-                    elif interactive["type"] == "list_reply":
-                        interactive_id = interactive["list_reply"]["id"]
-
-                log_interaction(phone_number, user_message=text, session_state=session.state)
-
-                # Commands
-                if text == "/reset":
-                    clear_session(phone_number)
-                    send_whatsapp_message(phone_number, "🧹 Memory cleared. Let's start fresh!")
-                    continue
-                elif text == "/debug":
-                    history = json.loads(session.history) if session.history else []
-                    reply = "🧪 Current memory:\n" + "\n".join(
-                        [f"{m['role']}: {m['content']}" for m in history]
-                    ) if history else "🧪 No memory found."
-                    send_whatsapp_message(phone_number, reply)
-                    continue
-
-                # Start symptom checker
-                if text == "check":
-                    start_symptom_checker(phone_number)
-                    continue
-
-                # Handle symptom checker flow
-                if session.state == "symptom_check":
-                    if interactive_id:
-                        if interactive_id.startswith("symptom_") or interactive_id == "finish":
-                            handle_symptom_selection(phone_number, interactive_id)
-                        elif interactive_id == "add_more":
-                            send_whatsapp_message(phone_number, "🩺 Please type another symptom:")
-                        continue
-                    elif text and text != "check":  # user typed a symptom
-                        handle_symptom_search(phone_number, text)
-                        continue
-
-                # Handle follow-up flow ✅ patched
-                if session.state == "followup_check" and interactive_id:
-                    if interactive_id.startswith("followup_yes_") or interactive_id.startswith("followup_no_"):
-                        handle_followup_response(phone_number, interactive_id)
-                        continue
-
-                # Predefined replies
-                reply = match_predefined(text)
-                if reply:
-                    send_whatsapp_message(phone_number, reply)
-                    continue
-                else:
-                    # Only call LLM if no predefined response matched
-                    if text:
-                        reply = call_openrouter(text, phone_number)
-                        send_whatsapp_message(phone_number, reply)
-                        continue
+    if llm_texts:
+        answer_with_llm(phone_number, llm_texts)
 
-    return Response("EVENT_RECEIVED", status=200)
+def answer_with_llm(phone_number, llm_texts):
+    # Consecutive free-text messages are answered by one OpenRouter call.
+    # Pending changes are committed first so no write lock is held while the
+    # model responds.
+    db.session.commit()
+    reply = call_openrouter(llm_texts, phone_number)
+    session = load_session(phone_number)
+    if reply:
+        send_whatsapp_message(phone_number, reply, session.state if session else None)
+    compact_history(phone_number)
+    db.session.commit()
+
+def route_message(phone_number, session, message):
+    # Returns (text for the LLM, None) or (None, action replying to the message)
+    raw_text = message.get("text", {}).get("body")
+    text = raw_text.strip().lower() if raw_text else ""
+    interactive_id = None
+    if "interactive" in message:
+        interactive = message["interactive"]
+        if interactive["type"] == "button_reply":
+            interactive_id = interactive["button_reply"]["id"]
+        elif interactive["type"] == "list_reply":
+            interactive_id = interactive["list_reply"]["id"]
+
+    log_interaction(phone_number, user_message=text, session_state=session.state)
+
+    # Commands (including 'check' to start the symptom checker)
+    command = _COMMAND_HANDLERS.get(text)
+    if command:
+        return None, partial(command, phone_number, session)
+
+    # Button/list replies for the symptom checker and follow-up flows
+    if interactive_id:
+        handlers = _INTERACTIVE_HANDLERS.get(session.state)
+        if handlers is not None:
+            handler = handlers.get(interactive_id) or handlers.get(interactive_id.split("_", 1)[0])
+            return None, handler and partial(handler, phone_number, interactive_id)
+
+    if session.state == "symptom_check" and text:  # user typed a symptom
+        return None, partial(handle_symptom_search, phone_number, text)
+
+    # Predefined replies
+    reply = match_predefined(text) or (match_trivial(text) if text else None)
+    if reply:
+        return None, partial(send_whatsapp_message, phone_number, reply, session.state)
+    # Only call LLM if no predefined response matched
+    return text, None
 
 
 @app.route('/')
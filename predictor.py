@@ -1,27 +1,28 @@
+import os
+import threading
 import pandas as pd
 import numpy as np
 import csv
+import joblib
+import sklearn
+from functools import lru_cache
+from itertools import chain
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.model_selection import train_test_split
 from sklearn import preprocessing
 from sklearn.calibration import CalibratedClassifierCV
-from difflib import get_close_matches
+from sklearn.frozen import FrozenEstimator
+from rapidfuzz import process, fuzz
 
-# Load training data
-training = pd.read_csv("Data/Training.csv")
-cols = training.columns[:-1]
-x = training[cols]
-y = training["prognosis"]
+try:
+    import fcntl
+except ImportError:  # Windows: no flock, concurrent workers may each train
+    fcntl = None
 
-# Encode target labels
-le = preprocessing.LabelEncoder()
-y_encoded = le.fit_transform(y)
-
-# Train Random Forest with calibration
-x_train, x_test, y_train, y_test = train_test_split(x, y_encoded, test_size=0.33, random_state=42)
-rf = RandomForestClassifier(n_estimators=200, random_state=42)
-clf = CalibratedClassifierCV(rf, method='isotonic')
-clf.fit(x_train, y_train)
+MODEL_PATH = "Data/model.joblib"
+MODEL_VERSION = 4  # bump when build_model changes, to discard saved models
+DATA_FILES = ["Data/Training.csv", "Data/Symptom_severity.csv",
+              "Data/symptom_Description.csv", "Data/symptom_precaution.csv"]
 
 # Load dictionaries
 severityDictionary, description_list, precautionDictionary = {}, {}, {}
@@ -40,22 +41,144 @@ def load_dictionaries():
     except Exception as e:
         print(f"⚠️ Dictionary load failed: {e}")
 
-load_dictionaries()
+def build_model():
+    # Load training data: symptom columns are 0/1 flags, so read them as int8
+    # rather than letting pandas infer int64
+    with open("Data/Training.csv", newline="") as f:
+        header = next(csv.reader(f))
+    dtypes = {**dict.fromkeys(header[:-1], np.int8), header[-1]: "category"}
+    training = pd.read_csv("Data/Training.csv", dtype=dtypes, engine="c")
+    # The header repeats fluid_overload and pandas renames the copy to
+    # "fluid_overload.1"; fold copies back in so every column is a real name
+    for column in header[:-1]:
+        copies = [c for c in training.columns if c.startswith(f"{column}.") and c[len(column) + 1:].isdigit()]
+        if copies:
+            training[column] = training[[column, *copies]].max(axis=1).astype(np.int8)
+            training = training.drop(columns=copies)
+    cols = training.columns[:-1]
+    x = training[cols]
+    y = training["prognosis"]
+
+    # Encode target labels
+    le = preprocessing.LabelEncoder()
+    y_encoded = le.fit_transform(y)
+
+    # Train Random Forest, then calibrate it once on the held-out split. A CV
+    # wrapper would keep one forest per fold and run them all on every predict
+    x_train, x_test, y_train, y_test = train_test_split(x, y_encoded, test_size=0.33, random_state=42)
+    rf = RandomForestClassifier(n_estimators=100, random_state=42)
+    rf.fit(x_train, y_train)
+    clf = CalibratedClassifierCV(FrozenEstimator(rf), method='isotonic')
+    clf.fit(x_test, y_test)
+
+    load_dictionaries()
+
+    # Follow-ups are scored by severity + frequency of occurrence across the
+    # training rows; neither depends on the request, so rank them all here
+    symptom_frequency = training[cols].sum()
+    followup_rank = sorted(
+        (symptom.lower() for symptom in cols),
+        key=lambda s: severityDictionary.get(s, 0) + symptom_frequency[s],
+        reverse=True
+    )
+
+    # Per disease: the symptoms its training rows show most often, so the
+    # follow-up questions can confirm or rule out the predicted disease
+    disease_share = training.groupby("prognosis", observed=True)[cols].mean()
+    disease_followups = {
+        disease: [
+            s.lower() for s in sorted(
+                (s for s in cols if row[s] > 0),
+                key=lambda s: (row[s], severityDictionary.get(s.lower(), 0)),
+                reverse=True
+            )
+        ]
+        for disease, row in disease_share.iterrows()
+    }
+    # Follow-ups are sent back as symptom names, so they must all be real ones
+    names = {symptom.lower() for symptom in cols}
+    unknown = {s for ranked in disease_followups.values() for s in ranked} - names
+    if unknown:
+        raise ValueError(f"Follow-up symptoms missing from the dataset columns: {sorted(unknown)}")
+
+    return {
+        "version": MODEL_VERSION,
+        "sklearn_version": sklearn.__version__,
+        "clf": clf,
+        "le": le,
+        "cols": list(cols),
+        "followup_rank": followup_rank,
+        "disease_followups": disease_followups,
+        "severity": severityDictionary,
+        "descriptions": description_list,
+        "precautions": precautionDictionary,
+    }
+
+def load_saved_model():
+    # Training takes seconds, so reuse the saved model unless the data files
+    # or the sklearn version changed since it was written
+    try:
+        if os.path.getmtime(MODEL_PATH) >= max(map(os.path.getmtime, DATA_FILES)):
+            model = joblib.load(MODEL_PATH)
+            if (model.get("version"), model.get("sklearn_version")) == (MODEL_VERSION, sklearn.__version__):
+                return model
+    except Exception:
+        pass
+    return None
+
+def load_model():
+    model = load_saved_model()
+    if model:
+        return model
+
+    # Workers booting together queue on the lock: the first one trains and
+    # saves, the rest pick up its file instead of training again
+    with open(f"{MODEL_PATH}.lock", "w") as lock_file:
+        if fcntl:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        model = load_saved_model()
+        if model:
+            return model
+
+        model = build_model()
+        try:
+            # Write then rename, so a concurrent loader never sees a partial file
+            tmp_path = f"{MODEL_PATH}.{os.getpid()}.tmp"
+            joblib.dump(model, tmp_path)
+            os.replace(tmp_path, MODEL_PATH)
+        except Exception as e:
+            print(f"⚠️ Model save failed: {e}")
+    return model
+
+model = load_model()
+clf, le, cols = model["clf"], model["le"], model["cols"]
+severityDictionary.update(model["severity"])
+description_list.update(model["descriptions"])
+precautionDictionary.update(model["precautions"])
+FOLLOWUP_RANK = model["followup_rank"]
+DISEASE_FOLLOWUPS = model["disease_followups"]
 
 # Map symptoms to indices
 symptoms_dict = {symptom.lower(): idx for idx, symptom in enumerate(cols)}
+symptom_names = list(symptoms_dict)
+# Some dataset names mix spaces and underscores ("spotting_ urination"), so
+# incoming names are matched with both stripped out
+symptom_keys = {name.replace("_", "").replace(" ", ""): name for name in symptom_names}
 
-# Quick autocomplete matcher
+# Quick autocomplete matcher (RapidFuzz's C++ scorer; ratio matches difflib's scale)
 def suggest_symptoms(partial, n=5):
     partial = partial.strip().lower()
     if not partial:
         return []
-    matches = get_close_matches(partial, symptoms_dict.keys(), n=n, cutoff=0.5)
-    return matches
+    matches = process.extract(partial, symptom_names, scorer=fuzz.ratio, limit=n, score_cutoff=50)
+    return [name for name, _score, _idx in matches]
+
+# Severity weight per symptom column, so a request sums one small slice
+severity_vector = np.array([severityDictionary.get(name, 0) for name in symptom_names], dtype=np.int16)
 
 # Severity calc (adjusted to avoid huge inflation by days)
-def calc_severity(symptoms, days):
-    score = sum(severityDictionary.get(symptom, 0) for symptom in symptoms)
+def calc_severity(indices, days):
+    score = int(severity_vector[indices].sum())
     severity = score + min(days, 7) * 0.5
     if severity > 13:
         return "high"
@@ -64,54 +187,73 @@ def calc_severity(symptoms, days):
     else:
         return "low"
 
+# Disease name, description and precautions for each predict_proba column
+class_names = le.inverse_transform(clf.classes_).tolist()
+class_descriptions = [description_list.get(d.lower(), "No description available.") for d in class_names]
+class_precautions = [precautionDictionary.get(d.lower(), ["No precautions found."]) for d in class_names]
+
 # Disease prediction
-def sec_predict(symptoms):
-    input_vector = np.zeros(len(symptoms_dict))
-    for symptom in symptoms:
-        if symptom in symptoms_dict:
-            input_vector[symptoms_dict[symptom]] = 1
+_input_rows = threading.local()
+
+def sec_predict(indices):
+    # Each thread reuses one input row, clearing only the cells it set last time
+    rows = _input_rows
+    if not hasattr(rows, "vector"):
+        rows.vector = np.zeros((1, len(symptoms_dict)), dtype=np.float32)
+        rows.indices = []
+    input_vector = rows.vector
+    input_vector[0, rows.indices] = 0
+    input_vector[0, indices] = 1
+    rows.indices = indices
 
-    prediction = clf.predict([input_vector])[0]
-    proba = clf.predict_proba([input_vector])[0]
-    confidence = round(np.max(proba) * 100, 1)
-    disease = le.inverse_transform([prediction])[0]
+    # One pass through the ensemble; predict() is just the argmax of these
+    proba = clf.predict_proba(input_vector)[0]
+    best = proba.argmax()
+    confidence = round(proba[best] * 100, 1)
 
     # Lower bound on small inputs
-    if len(symptoms) < 3 and confidence > 80:
+    if len(indices) < 3 and confidence > 80:
         confidence = 80
-    return disease, confidence
+    # Column index into class_names and the other per-class tables
+    return best, confidence
 
 # Smarter follow-ups
-def suggest_followup(symptoms, top_n=3):
-    remaining = [s for s in symptoms_dict if s not in symptoms]
-    # Score by severity + frequency of occurrence across predicted diseases
-    ranked = sorted(
-        remaining,
-        key=lambda s: severityDictionary.get(s, 0) + sum(training[s]),
-        reverse=True
-    )
-    return ranked[:top_n]
+def suggest_followup(symptoms, top_n=3, disease=None):
+    # The predicted disease's common symptoms first, then the global ranking
+    seen = set(symptoms)
+    picks = []
+    for s in chain(DISEASE_FOLLOWUPS.get(disease, ()), FOLLOWUP_RANK):
+        if s not in seen:
+            seen.add(s)
+            picks.append(s)
+            if len(picks) == top_n:
+                break
+    return picks
 
 # Main interface
 def predict_disease(symptoms, days):
-    symptoms = [s.strip().replace(" ", "_").lower() for s in symptoms]
-    matched = [s for s in symptoms if s in symptoms_dict]
+    keys = (s.lower().replace("_", "").replace(" ", "") for s in symptoms)
+    matched = [symptom_keys[k] for k in keys if k in symptom_keys]
     if not matched:
         return {"error": "No valid symptoms found."}
+    # Follow-up rounds re-submit the same sets; callers get their own copy
+    return dict(cached_prediction(tuple(sorted(matched)), days))
 
-    disease, confidence = sec_predict(matched)
-    description = description_list.get(disease.lower(), "No description available.")
-    precautions = precautionDictionary.get(disease.lower(), ["No precautions found."])
-    severity = calc_severity(matched, days)
+@lru_cache(maxsize=4096)
+def cached_prediction(matched, days):
+    # Names are resolved to column indices once and shared by both scorers
+    indices = np.array([symptoms_dict[s] for s in matched], dtype=np.intp)
+    best, confidence = sec_predict(indices)
+    severity = calc_severity(indices, days)
 
     result = {
-        "disease": disease,
-        "description": description,
-        "precautions": precautions,
+        "disease": class_names[best],
+        "description": class_descriptions[best],
+        "precautions": class_precautions[best],
         "severity": severity,
         "confidence": confidence,
     }
 
     if confidence < 70 or len(matched) < 3:
-        result["followup"] = suggest_followup(matched, top_n=3)
+        result["followup"] = suggest_followup(matched, top_n=3, disease=class_names[best])
     return result